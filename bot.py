@@ -1,21 +1,32 @@
+import time
+BOOT_T0 = time.perf_counter()
+
 import os
 import logging
-import requests
+import hashlib
 import json
-import time
 import tempfile
 import asyncio
+import copy
+import hmac
+import signal
+from collections import Counter, deque
+from urllib.parse import urlparse, parse_qs
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import (
     Application,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
     ContextTypes,
 )
-from flask import Flask
-from threading import Thread
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+from threading import Thread, Event, Lock
+# requests is imported lazily in http() - it is only needed once a link arrives
 
 # ==================== Logging ====================
 logging.basicConfig(
@@ -38,6 +49,47 @@ MAX_DOWNLOAD_SIZE = 50 * 1024 * 1024  # 50MB - server download limit
 DOWNLOAD_TIMEOUT = 120  # 2 min max download time
 UPLOAD_TIMEOUT = 120    # 2 min max upload time
 
+# Signed CDN links expire - refresh them through Zyla before they do
+LINK_REFRESH_MARGIN = 5 * 60   # refresh if a link expires within 5 min
+LINK_MAX_AGE = 30 * 60         # for links without a readable expiry
+MAX_LINK_RETRIES = 2           # refresh/resume attempts per download
+
+# Redeploys - Render sends SIGKILL 30s after SIGTERM
+SHUTDOWN_GRACE = int(os.environ.get("SHUTDOWN_GRACE", 25))  # max time to drain transfers
+DATA_DIR = os.environ.get("DATA_DIR", tempfile.gettempdir())  # point at a persistent disk
+TEMP_PREFIX = "fbdl_"  # our temp files, swept at startup
+COMMANDS_HASH_FILE = os.path.join(DATA_DIR, "commands.sha1")
+
+def _id_set(name):
+    """Comma separated Telegram user ids from an env var"""
+    return {int(i) for i in os.environ.get(name, "").split(",") if i.strip()}
+
+# Analytics
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # for /admin/stats
+ADMIN_IDS = _id_set("ADMIN_IDS")  # for /globalstats, no limits
+EVENTS_FILE = os.path.join(DATA_DIR, "events.jsonl")     # raw events since the last snapshot
+ROLLUP_FILE = os.path.join(DATA_DIR, "analytics.json")   # roll-up snapshot
+ANALYTICS_FLUSH_INTERVAL = 10       # seconds between batched writes
+ANALYTICS_SNAPSHOT_INTERVAL = 600   # seconds between roll-up snapshots (log is truncated after)
+ANALYTICS_KEEP_HOURS = 24 * 7
+ANALYTICS_TOP_VIDEOS = 500
+
+# Abuse protection
+RATE_LIMIT = int(os.environ.get("RATE_LIMIT", 5))    # links (and sends) per user per RATE_WINDOW
+RATE_WINDOW = 60                                      # seconds (sliding)
+LOOKUP_CACHE_TTL = 120                                # seconds a Zyla answer is reused for the same link
+DAILY_BYTE_QUOTA = int(os.environ.get("DAILY_QUOTA_MB", 500)) * 1024 * 1024
+BANNED_IDS = _id_set("BANNED_IDS")    # ignored completely
+ALLOWED_IDS = _id_set("ALLOWED_IDS")  # no rate limit / quota
+
+# ==================== Startup ====================
+startup_phases = {}  # phase -> ms since process start
+
+def mark_phase(name):
+    startup_phases[name] = round((time.perf_counter() - BOOT_T0) * 1000)
+
+mark_phase("imports")
+
 # ==================== Flask ====================
 app_flask = Flask(__name__)
 
@@ -47,13 +99,332 @@ def home():
 
 @app_flask.route("/health")
 def health():
+    if shutting_down.is_set():
+        return "Shutting down", 503
     return "OK", 200
 
+@app_flask.route("/startup")
+def startup():
+    return jsonify(startup_phases), 200
+
+@app_flask.route("/admin/stats")
+def admin_stats():
+    # Header only - query strings end up in the access log
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return "Forbidden", 403
+    return jsonify(analytics_snapshot()), 200
+
 def run_flask():
-    app_flask.run(host="0.0.0.0", port=PORT)
+    # make_server binds right away, so the "health" phase marks a listening port
+    server = make_server("0.0.0.0", PORT, app_flask, threaded=True)
+    mark_phase("health")
+    server.serve_forever()
+
+# ==================== Lifecycle ====================
+
+STARTED_AT = time.time()
+shutting_down = Event()     # set on SIGTERM - no new updates are taken
+abort_transfers = Event()   # set when the drain deadline passes
+active_transfers = set()    # in-flight smart_send tasks
+
+def sweep_temp_files():
+    """Removes temp files left behind by earlier runs"""
+    tmp_dir = tempfile.gettempdir()
+    removed = 0
+    for name in os.listdir(tmp_dir):
+        p = os.path.join(tmp_dir, name)
+        try:
+            if name.startswith(TEMP_PREFIX) and os.path.getmtime(p) < STARTED_AT:
+                os.remove(p)
+                removed += 1
+        except OSError:
+            pass
+    if removed:
+        logger.info(f"Swept {removed} stale temp file(s)")
+
+async def run_transfer(coro):
+    """Runs a transfer so shutdown can wait for it (or cancel it after the deadline)"""
+    task = asyncio.ensure_future(coro)
+    active_transfers.add(task)
+    task.add_done_callback(active_transfers.discard)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        # Only swallow our own cancel - not one aimed at the handler itself
+        if task.cancelled() and not asyncio.current_task().cancelling():
+            logger.warning("Transfer cancelled by shutdown")
+            return False, "shutdown", 0
+        raise
+
+async def graceful_shutdown(app):
+    """
+    SIGTERM handler:
+    1. Stop polling - Telegram keeps everything we haven't fetched
+    2. Finish already fetched updates and in-flight transfers within SHUTDOWN_GRACE
+    3. Cancel the rest (user gets a direct link) and stop - updates still
+       queued after the deadline only get a "restarting" reply
+    """
+    if shutting_down.is_set():
+        return
+    shutting_down.set()
+    logger.info("🛑 Shutdown requested, draining...")
+
+    # Fetched updates are marked read here, so they must be handled before we exit
+    if app.updater and app.updater.running:
+        await app.updater.stop()
+
+    try:
+        await asyncio.wait_for(app.update_queue.join(), timeout=SHUTDOWN_GRACE)
+    except asyncio.TimeoutError:
+        logger.warning(f"Drain deadline hit, {app.update_queue.qsize()} update(s) still queued")
+        abort_transfers.set()
+        left = set(active_transfers)
+        if left:
+            logger.warning(f"Cancelling {len(left)} transfer(s)")
+            for t in left:
+                t.cancel()
+            await asyncio.wait(left, timeout=3)
+
+    app.stop_running()
+
+# ==================== Analytics ====================
+# Hot path only appends to a deque; a background thread writes batches
+# to the append-only EVENTS_FILE (one compact JSON per line) and folds
+# them into the in-memory roll-ups served by /admin/stats and /globalstats.
+# Every ANALYTICS_SNAPSHOT_INTERVAL the roll-ups are saved to ROLLUP_FILE
+# and the raw log is truncated, so neither disk use nor replay keeps growing.
+# User ids are replaced by a keyed hash before anything is written.
+
+_events = deque()
+_flush_lock = Lock()
+_stats_lock = Lock()
+analytics_stop = Event()
+
+rollup = {
+    "events": Counter(),   # event type -> count
+    "tiers": Counter(),    # delivery method (direct/upload/document/link)
+    "errors": Counter(),   # failure reason (only set when something failed)
+    "rejections": Counter(),  # rate limit / quota rejections by reason
+    "hours": Counter(),    # "YYYY-MM-DD HH" (UTC) -> events
+    "videos": Counter(),   # FB url -> successful lookups
+}
+video_titles = {}
+seen_users = {}      # UTC day -> hashed user ids, last ANALYTICS_KEEP_HOURS only
+analytics_since = time.time()  # start of the data window, kept in the snapshot
+_last_snapshot = time.monotonic()
+
+def track(event, uid=0, **fields):
+    """Records an analytics event. Never blocks - safe on the update path."""
+    fields.update(t=int(time.time()), e=event, u=uid)
+    _events.append(fields)
+
+def _anon(uid):
+    """Keyed hash of a user id - the event log never holds real ids"""
+    return hmac.new((TELEGRAM_BOT_TOKEN or "").encode(), str(uid).encode(), "sha256").hexdigest()[:12]
+
+def _apply(batch):
+    with _stats_lock:
+        for ev in batch:
+            rollup["events"][ev["e"]] += 1
+            rollup["hours"][time.strftime("%Y-%m-%d %H", time.gmtime(ev["t"]))] += 1
+            seen_users.setdefault(time.strftime("%Y-%m-%d", time.gmtime(ev["t"])), set()).add(ev["u"])
+            if "m" in ev:
+                rollup["tiers"][ev["m"]] += 1
+            if "r" in ev:
+                rollup["rejections" if ev["e"] == "rejected" else "errors"][ev["r"]] += 1
+            if ev["e"] == "lookup" and ev.get("ok"):
+                rollup["videos"][ev["url"]] += 1
+                video_titles[ev["url"]] = ev.get("ti", "")
+
+        # Keep the roll-ups bounded
+        if len(rollup["hours"]) > ANALYTICS_KEEP_HOURS:
+            for h in sorted(rollup["hours"])[:-ANALYTICS_KEEP_HOURS]:
+                del rollup["hours"][h]
+        keep_days = ANALYTICS_KEEP_HOURS // 24
+        for day in sorted(seen_users)[:-keep_days]:
+            del seen_users[day]
+        if len(rollup["videos"]) > 2 * ANALYTICS_TOP_VIDEOS:
+            rollup["videos"] = Counter(dict(rollup["videos"].most_common(ANALYTICS_TOP_VIDEOS)))
+            keep = {u: video_titles.get(u, "") for u in rollup["videos"]}
+            video_titles.clear()
+            video_titles.update(keep)
+
+def flush_events(snapshot=False):
+    """Writes queued events to disk and folds them into the roll-ups"""
+    with _flush_lock:
+        batch = []
+        while _events:
+            batch.append(_events.popleft())
+        if batch:
+            for ev in batch:
+                ev["u"] = _anon(ev["u"])
+            _apply(batch)
+            try:
+                with open(EVENTS_FILE, "a") as f:
+                    f.write("".join(json.dumps(ev, separators=(",", ":")) + "\n" for ev in batch))
+            except OSError as e:
+                logger.error(f"Analytics write: {e}")
+        if snapshot or time.monotonic() - _last_snapshot >= ANALYTICS_SNAPSHOT_INTERVAL:
+            save_rollup()
+
+def save_rollup():
+    """Saves the roll-ups and truncates the raw log they now include"""
+    global _last_snapshot
+    with _stats_lock:
+        state = {k: dict(v) for k, v in rollup.items()}
+        state["titles"] = dict(video_titles)
+        state["users"] = {day: list(ids) for day, ids in seen_users.items()}
+        state["since"] = analytics_since
+    try:
+        tmp = ROLLUP_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp, ROLLUP_FILE)
+        open(EVENTS_FILE, "w").close()
+        _last_snapshot = time.monotonic()
+    except OSError as e:
+        logger.error(f"Analytics snapshot: {e}")
+
+def load_events():
+    """Rebuilds the roll-ups from the last snapshot plus the events logged after it"""
+    global analytics_since
+    try:
+        with open(ROLLUP_FILE) as f:
+            state = json.load(f)
+        with _stats_lock:
+            for k in rollup:
+                rollup[k].update(state.get(k, {}))
+            video_titles.update(state.get("titles", {}))
+            users = state.get("users", {})
+            for day, ids in (users.items() if isinstance(users, dict) else ()):
+                seen_users.setdefault(day, set()).update(ids)
+            analytics_since = state.get("since", analytics_since)
+    except (OSError, ValueError):
+        pass
+
+    count = 0
+    try:
+        batch = []
+        with open(EVENTS_FILE) as f:
+            for line in f:
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    continue
+                if len(batch) >= 1000:
+                    _apply(batch)
+                    count += len(batch)
+                    batch = []
+        _apply(batch)
+        count += len(batch)
+    except OSError:
+        pass
+    logger.info(f"Analytics: loaded snapshot + {count} event(s)")
+
+def analytics_writer():
+    os.makedirs(DATA_DIR, exist_ok=True)
+    load_events()
+    while not analytics_stop.wait(ANALYTICS_FLUSH_INTERVAL):
+        flush_events()
+
+def analytics_snapshot():
+    with _stats_lock:
+        hours = sorted(rollup["hours"].items())[-24:]
+        return {
+            "since": time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(analytics_since)),
+            "users": len(set().union(*seen_users.values())),  # last 7 days
+            "users_today": len(seen_users.get(time.strftime("%Y-%m-%d", time.gmtime()), ())),
+            "events": dict(rollup["events"]),
+            "tiers": dict(rollup["tiers"]),
+            "errors": dict(rollup["errors"].most_common(10)),
+            "rejections": dict(rollup["rejections"]),
+            "hours": dict(hours),
+            "top_videos": [{"url": u, "title": video_titles.get(u, ""), "lookups": n}
+                           for u, n in rollup["videos"].most_common(10)],
+            "queued": len(_events),
+        }
+
+# ==================== Abuse Protection ====================
+# Everything here is in-memory and O(1)-ish, so abusive traffic is
+# rejected before it costs a Zyla call, a HEAD request or bandwidth.
+
+_recent = {}         # (kind, uid) -> deque of request times (sliding window)
+_recent_pruned = time.monotonic()
+_quota_day = None    # UTC day _bytes_used is for
+_bytes_used = {}     # uid -> bytes sent on _quota_day
+_lookups = {}        # FB url -> (fetched at, Zyla response), see cached_video_data
+
+def is_exempt(uid):
+    return uid in ALLOWED_IDS or uid in ADMIN_IDS
+
+def rate_limit_wait(uid, kind="link"):
+    """Records a request; returns seconds to wait if over the limit, else 0"""
+    global _recent_pruned
+    now = time.monotonic()
+
+    # Once per window, forget users whose hits have all expired
+    if now - _recent_pruned >= RATE_WINDOW:
+        for key in [k for k, h in _recent.items() if not h or now - h[-1] >= RATE_WINDOW]:
+            del _recent[key]
+        _recent_pruned = now
+
+    hits = _recent.setdefault((kind, uid), deque())
+    while hits and now - hits[0] >= RATE_WINDOW:
+        hits.popleft()
+    if len(hits) >= RATE_LIMIT:
+        return int(RATE_WINDOW - (now - hits[0])) + 1
+    hits.append(now)
+    return 0
+
+def _quota_today():
+    """Usage map for the current UTC day - yesterday's is dropped at rollover"""
+    global _quota_day
+    day = time.strftime("%Y-%m-%d", time.gmtime())
+    if day != _quota_day:
+        _bytes_used.clear()
+        _quota_day = day
+    return _bytes_used
+
+def quota_left(uid):
+    return DAILY_BYTE_QUOTA - _quota_today().get(uid, 0)
+
+def charge_quota(uid, n):
+    if n:
+        used = _quota_today()
+        used[uid] = used.get(uid, 0) + n
+
+def cached_video_data(url):
+    """
+    fetch_video_data with a short per-link cache: updates are handled one
+    at a time, so a repeated link is answered from here instead of
+    costing another Zyla call. Returns (data, fetched_at).
+    """
+    now = time.time()
+    hit = _lookups.get(url)
+    if hit and now - hit[0] < LOOKUP_CACHE_TTL:
+        return copy.deepcopy(hit[1]), hit[0]
+
+    data = fetch_video_data(url)
+    if data and not data.get("error", True):
+        if len(_lookups) >= 256:
+            for u in [u for u, (t, _) in _lookups.items() if now - t >= LOOKUP_CACHE_TTL]:
+                del _lookups[u]
+        _lookups[url] = (now, copy.deepcopy(data))
+    return data, now
 
 # ==================== Helpers ====================
 
+_http = None
+
+def http():
+    """Shared requests session, created on first use (keeps connections alive)"""
+    global _http
+    if _http is None:
+        import requests
+        _http = requests.Session()
+    return _http
+
 def is_facebook_url(url):
     domains = ["facebook.com", "fb.com", "fb.watch", "m.facebook.com", "web.facebook.com"]
     return any(d in url.lower() for d in domains)
@@ -61,13 +432,58 @@ def is_facebook_url(url):
 def fetch_video_data(fb_url):
     headers = {"Authorization": f"Bearer {ZYLA_API_KEY}", "Content-Type": "application/json"}
     try:
-        r = requests.post(ZYLA_API_URL, headers=headers, data=json.dumps({"url": fb_url}), timeout=30)
+        r = http().post(ZYLA_API_URL, headers=headers, data=json.dumps({"url": fb_url}), timeout=30)
         r.raise_for_status()
         return r.json()
     except Exception as e:
         logger.error(f"API: {e}")
         return None
 
+def url_expiry(url):
+    """Unix time a signed media url stops working, None if it has no expiry"""
+    qs = parse_qs(urlparse(url).query)
+    try:
+        if "oe" in qs:  # fbcdn - hex timestamp
+            return int(qs["oe"][0], 16)
+        for key in ("expires", "Expires", "exp"):
+            if key in qs:
+                return int(qs[key][0])
+    except ValueError:
+        pass
+    return None
+
+def link_expiring(media, vd):
+    exp = media.get("expires")
+    if exp:
+        return exp - time.time() < LINK_REFRESH_MARGIN
+    return time.time() - vd.get("fetched", 0) > LINK_MAX_AGE
+
+def refresh_links(vd):
+    """Re-resolves the FB link and swaps fresh media urls into vd (in place)"""
+    data = fetch_video_data(vd["url"])
+    if not data or data.get("error", True):
+        return False
+    medias = data.get("medias", [])
+    for kind, mtype in (("videos", "video"), ("audios", "audio")):
+        fresh = [m for m in medias if m.get("type") == mtype]
+        groups = {}  # (quality, extension) -> fresh variants, in order
+        for m in fresh:
+            groups.setdefault((m.get("quality"), m.get("extension")), []).append(m)
+        seen = Counter()
+        for pos, old in enumerate(vd.get(kind, [])):
+            # n-th variant of the same quality & format, else the same position
+            key = (old.get("quality"), old.get("extension"))
+            n = seen[key]
+            seen[key] += 1
+            same = groups.get(key, [])
+            new = same[n] if n < len(same) else (fresh[pos] if pos < len(fresh) else None)
+            if new:
+                old["url"] = new["url"]
+                old["expires"] = url_expiry(new["url"])
+    vd["fetched"] = time.time()
+    logger.info("Media links refreshed")
+    return True
+
 def fmt_dur(ms):
     if not ms: return "N/A"
     s = ms // 1000
@@ -80,7 +496,7 @@ def q_icon(q):
 
 def get_size(url):
     try:
-        r = requests.head(url, allow_redirects=True, timeout=10)
+        r = http().head(url, allow_redirects=True, timeout=10)
         return int(r.headers.get("content-length", 0))
     except:
         return 0
@@ -97,41 +513,83 @@ def cleanup(p):
         if p and os.path.exists(p): os.remove(p)
     except: pass
 
-def download_with_limit(url, ext="mp4", max_size=MAX_DOWNLOAD_SIZE, timeout=DOWNLOAD_TIMEOUT):
-    """ফাইল ডাউনলোড করে - সাইজ ও টাইম লিমিট সহ"""
+def download_with_limit(url, ext="mp4", max_size=MAX_DOWNLOAD_SIZE, timeout=DOWNLOAD_TIMEOUT, refresh=None):
+    """ফাইল ডাউনলোড করে - সাইজ ও টাইম লিমিট সহ
+    refresh() নতুন URL দেয় - লিংক expire (403/410) হলে সেখান থেকে resume করে"""
+    tmp = None
+    downloaded = 0
     try:
         start = time.time()
-        r = requests.get(url, stream=True, timeout=30)
-        r.raise_for_status()
-
-        # Check content-length header first
-        content_length = int(r.headers.get("content-length", 0))
-        if content_length > max_size:
-            logger.info(f"File too large: {fmt_size(content_length)} > {fmt_size(max_size)}")
-            r.close()
-            return None, content_length, "too_large"
-
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=f".{ext}", dir=tempfile.gettempdir())
-        downloaded = 0
-
-        for chunk in r.iter_content(chunk_size=512 * 1024):  # 512KB chunks
-            if chunk:
-                # Check time limit
-                if time.time() - start > timeout:
-                    tmp.close()
-                    cleanup(tmp.name)
-                    logger.warning("Download timeout!")
-                    return None, downloaded, "timeout"
-
-                # Check size limit
-                if downloaded + len(chunk) > max_size:
-                    tmp.close()
-                    cleanup(tmp.name)
-                    logger.info(f"Download exceeded limit at {fmt_size(downloaded)}")
+        retries = 0
+
+        while True:
+            headers = {"Range": f"bytes={downloaded}-"} if downloaded else {}
+            r = http().get(url, stream=True, timeout=30, headers=headers)
+
+            # Signed link expired - re-resolve and continue from where we are
+            if r.status_code in (403, 410) and refresh and retries < MAX_LINK_RETRIES:
+                r.close()
+                retries += 1
+                logger.info(f"Link expired ({r.status_code}), refreshing")
+                url = refresh()
+                if not url:
+                    if tmp: tmp.close(); cleanup(tmp.name)
+                    return None, downloaded, "expired"
+                continue
+            r.raise_for_status()
+
+            # Server ignored the Range header - start over
+            if downloaded and r.status_code != 206:
+                tmp.seek(0)
+                tmp.truncate()
+                downloaded = 0
+
+            if not downloaded:
+                # Check content-length header first
+                content_length = int(r.headers.get("content-length", 0))
+                if content_length > max_size:
+                    logger.info(f"File too large: {fmt_size(content_length)} > {fmt_size(max_size)}")
+                    r.close()
+                    if tmp: tmp.close(); cleanup(tmp.name)
                     return None, downloaded, "too_large"
 
-                tmp.write(chunk)
-                downloaded += len(chunk)
+            if tmp is None:
+                tmp = tempfile.NamedTemporaryFile(delete=False, prefix=TEMP_PREFIX, suffix=f".{ext}", dir=tempfile.gettempdir())
+
+            try:
+                for chunk in r.iter_content(chunk_size=512 * 1024):  # 512KB chunks
+                    if chunk:
+                        # Shutdown deadline passed
+                        if abort_transfers.is_set():
+                            tmp.close()
+                            cleanup(tmp.name)
+                            logger.warning("Download aborted by shutdown")
+                            return None, downloaded, "aborted"
+
+                        # Check time limit
+                        if time.time() - start > timeout:
+                            tmp.close()
+                            cleanup(tmp.name)
+                            logger.warning("Download timeout!")
+                            return None, downloaded, "timeout"
+
+                        # Check size limit
+                        if downloaded + len(chunk) > max_size:
+                            tmp.close()
+                            cleanup(tmp.name)
+                            logger.info(f"Download exceeded limit at {fmt_size(downloaded)}")
+                            return None, downloaded, "too_large"
+
+                        tmp.write(chunk)
+                        downloaded += len(chunk)
+            except Exception as e:
+                # Connection dropped mid-stream - resume with a Range request
+                if retries >= MAX_LINK_RETRIES:
+                    raise
+                retries += 1
+                logger.info(f"Stream broke at {fmt_size(downloaded)} ({e}), resuming")
+                continue
+            break
 
         tmp.close()
         logger.info(f"Downloaded {fmt_size(downloaded)} in {time.time()-start:.1f}s")
@@ -139,35 +597,33 @@ def download_with_limit(url, ext="mp4", max_size=MAX_DOWNLOAD_SIZE, timeout=DOWN
 
     except Exception as e:
         logger.error(f"Download error: {e}")
-        return None, 0, "error"
+        if tmp:
+            tmp.close()
+            cleanup(tmp.name)
+        return None, downloaded, "error"
 
 # ==================== Upload System ====================
 
-async def smart_send(ctx, chat_id, url, mtype, qual, vdata, ext, file_size, status_cb=None):
+async def smart_send(ctx, chat_id, url, mtype, qual, vdata, ext, file_size, status_cb=None, refresh=None):
     """
     Smart 3-tier upload:
     1. URL direct (≤20MB fast)
     2. Download + Upload (≤50MB)
     3. Direct link button (>50MB)
+
+    refresh() returns a fresh url if the link expires during Tier 2.
+    Returns (ok, method, bytes that went through our server).
     """
 
     icon = q_icon(qual) if mtype == "video" else "🎵"
     size_label = fmt_size(file_size)
 
-    caption = (
-        f"✅ **Download Complete!**\n\n"
-        f"━━━━━━━━━━━━━━━━━━━━\n"
-        f"📌 {vdata['title']}\n"
-        f"👤 {vdata['author']}\n"
-        f"{icon} Quality: **{qual}**\n"
-        f"📦 Size: **{size_label}**\n"
-        f"━━━━━━━━━━━━━━━━━━━━\n\n"
-        f"⚡ {BOT_USERNAME}"
-    )
+    caption = render("complete", title=vdata["title"], author=vdata["author"],
+                     icon=icon, quality=qual, size=size_label)
 
     # ===== TIER 1: Direct URL (fastest, Telegram fetches the file) =====
     if status_cb:
-        await status_cb(f"⚡ **Sending directly...**\n📦 {size_label}")
+        await status_cb(render("st_direct", size=size_label))
 
     try:
         if mtype == "video":
@@ -188,7 +644,7 @@ async def smart_send(ctx, chat_id, url, mtype, qual, vdata, ext, file_size, stat
                 ),
                 timeout=90
             )
-        return True, "direct"
+        return True, "direct", 0  # Telegram fetched it, not us
     except asyncio.TimeoutError:
         logger.warning("Tier 1 timeout")
     except Exception as e:
@@ -197,22 +653,32 @@ async def smart_send(ctx, chat_id, url, mtype, qual, vdata, ext, file_size, stat
     # ===== Check if file is too large for server download =====
     if file_size > MAX_DOWNLOAD_SIZE:
         logger.info(f"File {size_label} exceeds server limit, giving direct link")
-        return False, "too_large"
+        return False, "too_large", 0
 
     # ===== TIER 2: Download to server + Upload =====
     if status_cb:
-        await status_cb(f"📥 **Downloading to server...**\n📦 {size_label}\n⏳ Please wait...")
+        await status_cb(render("st_downloading", size=size_label))
 
-    path, actual_size, dl_status = download_with_limit(url, ext)
+    # Runs in a thread so the bot (and SIGTERM handling) stays responsive
+    path, actual_size, dl_status = await asyncio.to_thread(download_with_limit, url, ext, refresh=refresh)
 
     if dl_status != "ok" or not path:
         logger.warning(f"Download failed: {dl_status}")
-        return False, dl_status
+        return False, dl_status, actual_size
 
     actual_size_label = fmt_size(actual_size)
     if status_cb:
-        await status_cb(f"📤 **Uploading to Telegram...**\n📦 {actual_size_label}\n⏳ Almost done!")
+        await status_cb(render("st_uploading", size=actual_size_label))
 
+    # finally also runs if the transfer is cancelled on shutdown
+    try:
+        ok, method = await upload_file(ctx, chat_id, path, mtype, qual, ext, caption, actual_size_label, status_cb)
+        return ok, method, actual_size
+    finally:
+        cleanup(path)
+
+async def upload_file(ctx, chat_id, path, mtype, qual, ext, caption, actual_size_label, status_cb=None):
+    """Tier 2 upload of a downloaded file - as media first, then as document"""
     # Try send as video/audio
     try:
         with open(path, "rb") as f:
@@ -236,7 +702,6 @@ async def smart_send(ctx, chat_id, url, mtype, qual, vdata, ext, file_size, stat
                     ),
                     timeout=UPLOAD_TIMEOUT + 30
                 )
-        cleanup(path)
         return True, "upload"
     except asyncio.TimeoutError:
         logger.warning("Upload as media timeout")
@@ -246,7 +711,7 @@ async def smart_send(ctx, chat_id, url, mtype, qual, vdata, ext, file_size, stat
     # Try as document
     try:
         if status_cb:
-            await status_cb(f"📄 **Sending as document...**\n📦 {actual_size_label}")
+            await status_cb(render("st_document", size=actual_size_label))
 
         with open(path, "rb") as f:
             await asyncio.wait_for(
@@ -258,70 +723,45 @@ async def smart_send(ctx, chat_id, url, mtype, qual, vdata, ext, file_size, stat
                 ),
                 timeout=UPLOAD_TIMEOUT + 30
             )
-        cleanup(path)
         return True, "document"
     except asyncio.TimeoutError:
         logger.warning("Document upload timeout")
     except Exception as e:
         logger.error(f"Doc upload fail: {e}")
 
-    cleanup(path)
     return False, "upload_fail"
 
-# ==================== Commands ====================
-
-async def set_cmds(app):
-    await app.bot.set_my_commands([
-        BotCommand("start", "🚀 Start the bot"),
-        BotCommand("help", "📖 How to use this bot"),
-        BotCommand("about", "ℹ️ About this bot"),
-        BotCommand("supported", "📋 Supported link types"),
-        BotCommand("stats", "📊 Your usage stats"),
-        BotCommand("ping", "🏓 Check bot status"),
-        BotCommand("developer", "👨‍💻 Developer info"),
-        BotCommand("privacy", "🔒 Privacy policy"),
-    ])
-
-async def start_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    u = update.effective_user
-    if "downloads" not in ctx.user_data:
-        ctx.user_data["downloads"] = 0
-        ctx.user_data["joined"] = time.strftime("%Y-%m-%d")
-
-    txt = (
-        f"Hey **{u.first_name}**! 👋\n\n"
-        f"🎬 **Facebook Video Downloader**\n\n"
-        f"Download videos, reels & audio from\n"
-        f"Facebook — fast, free & easy!\n\n"
-        f"╔══════════════════════╗\n"
-        f"║ 🔹 Send a FB video link     ║\n"
-        f"║ 🔹 Choose quality               ║\n"
-        f"║ 🔹 Get your file!                  ║\n"
-        f"╚══════════════════════╝\n\n"
-        f"📦 Small files → Sent directly\n"
-        f"📦 Large files → Download link provided\n\n"
-        f"💡 Send a link to get started!\n\n"
+# ==================== Templates ====================
+# Built once at import. Static texts are final strings; the rest are
+# str.format templates with only the per-user fields left open.
+
+LINE = "━━━━━━━━━━━━━━━━━━━━"
+
+TEXTS = {
+    # ----- Commands -----
+    "start": (
+        "Hey **{name}**! 👋\n\n"
+        "🎬 **Facebook Video Downloader**\n\n"
+        "Download videos, reels & audio from\n"
+        "Facebook — fast, free & easy!\n\n"
+        "╔══════════════════════╗\n"
+        "║ 🔹 Send a FB video link     ║\n"
+        "║ 🔹 Choose quality               ║\n"
+        "║ 🔹 Get your file!                  ║\n"
+        "╚══════════════════════╝\n\n"
+        "📦 Small files → Sent directly\n"
+        "📦 Large files → Download link provided\n\n"
+        "💡 Send a link to get started!\n\n"
         f"🤖 {BOT_USERNAME} • v{BOT_VERSION}"
-    )
-    kb = [
-        [InlineKeyboardButton("📖 How to Use", callback_data="cb_help"),
-         InlineKeyboardButton("📋 Supported", callback_data="cb_supported")],
-        [InlineKeyboardButton("ℹ️ About", callback_data="cb_about"),
-         InlineKeyboardButton("🏓 Ping", callback_data="cb_ping")],
-        [InlineKeyboardButton("👨‍💻 Developer", callback_data="cb_dev"),
-         InlineKeyboardButton("🔒 Privacy", callback_data="cb_privacy")],
-    ]
-    await update.message.reply_text(txt, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
-
-async def help_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    txt = (
+    ),
+    "help": (
         "📖 **How to Use This Bot**\n\n"
         "**Step 1️⃣** — Find a video on Facebook\n"
         "**Step 2️⃣** — Tap `Share` → `Copy Link`\n"
         "**Step 3️⃣** — Paste the link here\n"
         "**Step 4️⃣** — Select quality (HD/SD/Audio)\n"
         "**Step 5️⃣** — Receive your file! 🎉\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"{LINE}\n\n"
         "📌 **Commands:**\n\n"
         "┌ /start — 🚀 Start the bot\n"
         "├ /help — 📖 How to use\n"
@@ -331,29 +771,26 @@ async def help_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "├ /ping — 🏓 Bot status\n"
         "├ /developer — 👨‍💻 Developer\n"
         "└ /privacy — 🔒 Privacy\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"{LINE}\n\n"
         "📦 **File Size Info:**\n"
         "• ≤50MB → Sent directly in chat\n"
         "• >50MB → Download link button\n\n"
         f"🤖 {BOT_USERNAME} • v{BOT_VERSION}"
-    )
-    await update.message.reply_text(txt, parse_mode="Markdown")
-
-async def about_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    txt = (
+    ),
+    "about": (
         "ℹ️ **About This Bot**\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"{LINE}\n\n"
         "🎬 **Facebook Video Downloader Bot**\n\n"
         "A fast Telegram bot that downloads\n"
         "videos, reels and audio from Facebook.\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"{LINE}\n\n"
         f"🤖 **Bot:** {BOT_USERNAME}\n"
         f"📌 **Version:** {BOT_VERSION}\n"
         f"👨‍💻 **Developer:** {DEVELOPER}\n"
         "🔧 **Language:** Python 3.11\n"
         "🌐 **API:** ZylaLabs\n"
         "☁️ **Hosting:** Render\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"{LINE}\n\n"
         "🎯 **Features:**\n\n"
         "┌ 📹 FB Videos & Reels\n"
         "├ 🔵 HD / 🟢 SD Quality\n"
@@ -366,11 +803,8 @@ async def about_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "├ 🔒 Privacy Focused\n"
         "└ 🆓 100% Free Forever\n\n"
         f"Made with ❤️ by {DEVELOPER}"
-    )
-    await update.message.reply_text(txt, parse_mode="Markdown")
-
-async def supported_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    txt = (
+    ),
+    "supported": (
         "📋 **Supported Link Types**\n\n"
         "✅ **Works:**\n"
         "┌ 🔗 `facebook.com/watch/...`\n"
@@ -386,28 +820,16 @@ async def supported_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "├ 🚫 Stories\n"
         "└ 🚫 Other platforms\n\n"
         f"🤖 {BOT_USERNAME}"
-    )
-    await update.message.reply_text(txt, parse_mode="Markdown")
-
-async def stats_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    u = update.effective_user
-    dl = ctx.user_data.get("downloads", 0)
-    joined = ctx.user_data.get("joined", "Today")
-    ranks = [(0,"🌱 Newbie"),(1,"⭐ Starter"),(5,"🔥 Regular"),
-             (15,"💎 Pro"),(30,"👑 Master"),(50,"🏆 Legend")]
-    rank = "🌱 Newbie"
-    for threshold, r in ranks:
-        if dl >= threshold: rank = r
-
-    txt = (
+    ),
+    "stats": (
         "📊 **Your Stats**\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n"
-        f"👤 **User:** {u.first_name}\n"
-        f"🆔 **ID:** `{u.id}`\n"
-        f"📅 **Since:** {joined}\n"
-        f"📥 **Downloads:** {dl}\n"
-        f"🏅 **Rank:** {rank}\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
+        f"{LINE}\n"
+        "👤 **User:** {name}\n"
+        "🆔 **ID:** `{id}`\n"
+        "📅 **Since:** {joined}\n"
+        "📥 **Downloads:** {downloads}\n"
+        "🏅 **Rank:** {rank}\n"
+        f"{LINE}\n\n"
         "🏅 **Ranks:**\n"
         "┌ 🌱 Newbie (0)\n"
         "├ ⭐ Starter (1-4)\n"
@@ -416,26 +838,17 @@ async def stats_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "├ 👑 Master (30-49)\n"
         "└ 🏆 Legend (50+)\n\n"
         f"🤖 {BOT_USERNAME}"
-    )
-    await update.message.reply_text(txt, parse_mode="Markdown")
-
-async def ping_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    t1 = time.time()
-    msg = await update.message.reply_text("🏓 Pinging...")
-    ms = round((time.time() - t1) * 1000)
-    st = "🟢 Excellent" if ms < 500 else ("🟡 Good" if ms < 1000 else "🔴 Slow")
-    await msg.edit_text(
-        f"🏓 **Pong!**\n\n"
-        f"⚡ Latency: `{ms}ms`\n"
-        f"📶 {st}\n"
-        f"🕐 `{time.strftime('%H:%M:%S UTC')}`\n"
-        f"📌 v{BOT_VERSION} ✅",
-        parse_mode="Markdown")
-
-async def developer_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    txt = (
+    ),
+    "ping": (
+        "🏓 **Pong!**\n\n"
+        "⚡ Latency: `{ms}ms`\n"
+        "📶 {status}\n"
+        "🕐 `{time}`\n"
+        f"📌 v{BOT_VERSION} ✅"
+    ),
+    "developer": (
         "👨‍💻 **Developer Info**\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n"
+        f"{LINE}\n"
         f"🧑‍💻 {DEVELOPER}\n"
         f"🤖 {BOT_USERNAME} • v{BOT_VERSION}\n\n"
         "🛠️ **Stack:**\n"
@@ -445,48 +858,331 @@ async def developer_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "├ 🐳 Docker\n"
         "└ ☁️ Render\n\n"
         f"💬 Feedback: {DEVELOPER}"
-    )
-    await update.message.reply_text(txt, parse_mode="Markdown")
-
-async def privacy_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    txt = (
+    ),
+    "privacy": (
         "🔒 **Privacy Policy**\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
-        "📌 **We collect:** Nothing permanent\n"
-        "🚫 **We don't store:** Links, files, data\n"
+        f"{LINE}\n\n"
+        "📌 **We collect:** Anonymous usage stats\n"
+        "📊 **Stats keep:** Requested FB links, titles & counts\n"
+        "🚫 **We don't store:** Your name, ID or files\n"
         "🗑️ **Temp files:** Deleted immediately\n"
         "🔐 **Connection:** HTTPS encrypted\n\n"
         f"Your privacy is safe! ✅\n\n🤖 {BOT_USERNAME}"
-    )
-    await update.message.reply_text(txt, parse_mode="Markdown")
+    ),
+
+    # ----- Menu pages (inline buttons) -----
+    "cb_help": (
+        "📖 **How to Use**\n\n"
+        "1️⃣ Copy a Facebook video link\n"
+        "2️⃣ Paste it here\n3️⃣ Choose quality\n"
+        "4️⃣ Get your file! 🎉\n\n"
+        f"🤖 {BOT_USERNAME}"
+    ),
+    "cb_supported": (
+        "📋 **Supported**\n\n✅ facebook.com/watch\n✅ facebook.com/reel\n"
+        "✅ facebook.com/video\n✅ fb.watch\n✅ m.facebook.com\n\n"
+        f"❌ Private/Stories/Live\n\n🤖 {BOT_USERNAME}"
+    ),
+    "cb_about": (
+        f"ℹ️ **About**\n\n🤖 {BOT_USERNAME}\n📌 v{BOT_VERSION}\n"
+        f"👨‍💻 {DEVELOPER}\n🆓 Free\n\nMade with ❤️"
+    ),
+    "cb_ping": "🏓 **Pong!**\n🟢 Online\n🕐 {time} ✅",
+    "cb_dev": f"👨‍💻 **Developer**\n\n{DEVELOPER}\n🐍 Python • ☁️ Render",
+    "cb_privacy": (
+        "🔒 **Privacy**\n\n📊 Anonymous stats only\n🚫 No IDs or files stored\n"
+        "🗑️ Files deleted instantly\n🔐 HTTPS ✅"
+    ),
+    "cb_back": (
+        "Hey **{name}**! 👋\n\n🎬 **Facebook Video Downloader**\n\n"
+        f"Send any FB link!\n\n🤖 {BOT_USERNAME}"
+    ),
+
+    # ----- Limits -----
+    "slow_down": (
+        "🐢 **Slow down!**\n\n"
+        f"You can send up to {RATE_LIMIT} links per minute.\n"
+        "⏳ Try again in **{wait}s**."
+    ),
+    "quota": (
+        "📦 **Daily limit reached!**\n\n"
+        f"You've used your {DAILY_BYTE_QUOTA // (1024 * 1024)} MB for today.\n"
+        "🕛 Resets at 00:00 UTC."
+    ),
+    "quota_alert": "📦 Daily limit reached! Resets at 00:00 UTC.",
+
+    # ----- Link lookup -----
+    "invalid_link": (
+        "🚫 **Invalid Link!**\n\n"
+        "Send a valid Facebook video/reel link.\n\n"
+        "💡 Example:\n`https://www.facebook.com/reel/569975832234512`"
+    ),
+    "processing": "🔍 **Processing...**\n⏳ Fetching video details.",
+    "not_found": (
+        "❌ **Video Not Found!**\n\n"
+        "┌ 🔒 Might be private\n├ 🗑️ Might be deleted\n└ 🔗 Invalid link\n\n"
+        "💡 Check and try again."
+    ),
+    "no_media": "❌ No downloadable media found!",
+    "checking_sizes": "📦 **Checking file sizes...**",
+    "video_found": (
+        "✅ **Video Found!**\n\n"
+        f"{LINE}\n"
+        "📌 **Title:** {title}\n"
+        "👤 **Author:** {author}\n"
+        "⏱️ **Duration:** {duration}\n"
+        "📦 **Formats:** {videos} video, {audios} audio\n"
+        f"{LINE}\n\n"
+        "👇 **Select quality:**{large_note}"
+    ),
+    "large_note": "\n\n💡 🔗 = Large file, download link will be provided",
+    "btn_video": "{icon} {quality} ({ext}{size})",
+    "btn_audio": "🎵 Audio ({ext}{size})",
+    "btn_open_fb": "🔗 Open on Facebook",
+
+    # ----- Downloads -----
+    "session_expired": "⚠️ Session expired! Send link again.",
+    "link_not_found": "❌ Link not found!",
+    "btn_download": "⬇️ Download {quality} ({size})",
+    "btn_open_fb_short": "🔗 Open Facebook",
+    "link_ready_large": (
+        "📥 **Download Link Ready!**\n\n"
+        f"{LINE}\n"
+        "📌 {title}\n"
+        "{icon} Quality: **{quality}**\n"
+        "📦 Size: **{size}**\n"
+        f"{LINE}\n\n"
+        "👆 Tap the button above to download!\n\n"
+        "💡 The file is too large to send via\n"
+        "Telegram, but you can download it\n"
+        "directly to your device.\n\n"
+        "📥 Downloads: {downloads}\n\n"
+        f"🤖 {BOT_USERNAME}"
+    ),
+    "link_ready_short": "📥 **Download {quality}** ({size}):",
+    "link_ready": (
+        "📥 **Download Link Ready!**\n\n"
+        f"{LINE}\n"
+        "📌 {title}\n"
+        "{icon} **{quality}** • {size}\n"
+        f"{LINE}\n\n"
+        "👆 Tap button to download!\n\n"
+        "📥 Downloads: {downloads}\n\n"
+        f"🤖 {BOT_USERNAME}"
+    ),
+    "link_fallback": "📥 Download:",
+    "progress": (
+        f"{{status}}\n\n{LINE}\n"
+        "{icon} **{quality}** • {size}\n"
+        f"📌 {{title}}\n{LINE}"
+    ),
+    "st_direct": "⚡ **Sending directly...**\n📦 {size}",
+    "st_downloading": "📥 **Downloading to server...**\n📦 {size}\n⏳ Please wait...",
+    "st_uploading": "📤 **Uploading to Telegram...**\n📦 {size}\n⏳ Almost done!",
+    "st_document": "📄 **Sending as document...**\n📦 {size}",
+    "complete": (
+        "✅ **Download Complete!**\n\n"
+        f"{LINE}\n"
+        "📌 {title}\n"
+        "👤 {author}\n"
+        "{icon} Quality: **{quality}**\n"
+        "📦 Size: **{size}**\n"
+        f"{LINE}\n\n"
+        f"⚡ {BOT_USERNAME}"
+    ),
+    "sent": (
+        "✅ **Sent Successfully!**\n\n"
+        f"{LINE}\n"
+        "📌 {title}\n"
+        "{icon} **{quality}** • {size}\n"
+        "📡 {method}\n"
+        "📥 Downloads: {downloads}\n"
+        f"{LINE}\n\n"
+        "Send another link! 🔗"
+    ),
+    "method_direct": "⚡ Direct",
+    "method_upload": "📤 Upload",
+    "method_document": "📄 Document",
+
+    # ----- Misc -----
+    "pinging": "🏓 Pinging...",
+    "ping_fast": "🟢 Excellent",
+    "ping_ok": "🟡 Good",
+    "ping_slow": "🔴 Slow",
+    "error": f"⚠️ Something went wrong. Try again.\n🤖 {BOT_USERNAME}",
+    "globalstats": (
+        "📈 Global Stats\n\n"
+        "👥 Users (7d): {users} • today: {users_today}\n"
+        "🕐 Busiest hour (24h): {busiest} UTC ({busiest_count})\n\n"
+        "📊 Events:\n{events}\n\n"
+        "📡 Delivery tiers:\n{tiers}\n\n"
+        "⚠️ Errors:\n{errors}\n\n"
+        "🚧 Rejected:\n{rejections}\n\n"
+        "🔥 Top videos:\n{top}"
+    ),
+
+    # ----- Shutdown -----
+    "restarting": "🔄 **Bot is restarting!**\n\nPlease resend your link in a moment.",
+    "restarting_alert": "🔄 Bot is restarting, please try again in a moment.",
+    "slow_down_alert": "🐢 Slow down! Try again in {wait}s.",
+}
+
+RANKS = [(0, "🌱 Newbie"), (1, "⭐ Starter"), (5, "🔥 Regular"),
+         (15, "💎 Pro"), (30, "👑 Master"), (50, "🏆 Legend")]
+
+HOME_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📖 How to Use", callback_data="cb_help"),
+     InlineKeyboardButton("📋 Supported", callback_data="cb_supported")],
+    [InlineKeyboardButton("ℹ️ About", callback_data="cb_about"),
+     InlineKeyboardButton("🏓 Ping", callback_data="cb_ping")],
+    [InlineKeyboardButton("👨‍💻 Developer", callback_data="cb_dev"),
+     InlineKeyboardButton("🔒 Privacy", callback_data="cb_privacy")],
+])
+BACK_KB = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="cb_back")]])
+
+def render(key, **fields):
+    """Text for `key`; only templates with per-user fields are formatted"""
+    return TEXTS[key].format(**fields) if fields else TEXTS[key]
+
+# ==================== Commands ====================
+
+BOT_COMMANDS = [
+    ("start", "🚀 Start the bot"),
+    ("help", "📖 How to use this bot"),
+    ("about", "ℹ️ About this bot"),
+    ("supported", "📋 Supported link types"),
+    ("stats", "📊 Your usage stats"),
+    ("ping", "🏓 Check bot status"),
+    ("developer", "👨‍💻 Developer info"),
+    ("privacy", "🔒 Privacy policy"),
+]
+
+async def set_cmds(app):
+    """Sends the command list only if Telegram doesn't already have it"""
+    digest = hashlib.sha1(json.dumps([TELEGRAM_BOT_TOKEN.split(":")[0], BOT_COMMANDS]).encode()).hexdigest()
+    try:
+        with open(COMMANDS_HASH_FILE) as f:
+            if f.read().strip() == digest:
+                logger.info("Commands unchanged, skipping set_my_commands")
+                return
+    except OSError:
+        pass
+
+    try:
+        # The hash file is gone after a fresh deploy - ask Telegram before re-sending
+        current = [(c.command, c.description) for c in await app.bot.get_my_commands()]
+        if current != BOT_COMMANDS:
+            await app.bot.set_my_commands([BotCommand(c, d) for c, d in BOT_COMMANDS])
+            logger.info("Commands set!")
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(COMMANDS_HASH_FILE, "w") as f:
+            f.write(digest)
+    except Exception as e:
+        logger.error(f"set_my_commands: {e}")
+
+def ensure_user(ctx):
+    if "downloads" not in ctx.user_data:
+        ctx.user_data["downloads"] = 0
+        ctx.user_data["joined"] = time.strftime("%Y-%m-%d")
+
+async def start_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    ensure_user(ctx)
+    await update.message.reply_text(
+        render("start", name=update.effective_user.first_name),
+        parse_mode="Markdown", reply_markup=HOME_KB)
+
+def static_command(key):
+    """Handler that replies with a pre-rendered text"""
+    async def command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        await update.message.reply_text(TEXTS[key], parse_mode="Markdown")
+    return command
+
+help_command = static_command("help")
+about_command = static_command("about")
+supported_command = static_command("supported")
+developer_command = static_command("developer")
+privacy_command = static_command("privacy")
+
+async def stats_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    u = update.effective_user
+    dl = ctx.user_data.get("downloads", 0)
+    rank = RANKS[0][1]
+    for threshold, r in RANKS:
+        if dl >= threshold: rank = r
+
+    await update.message.reply_text(
+        render("stats", name=u.first_name, id=u.id,
+               joined=ctx.user_data.get("joined", "Today"), downloads=dl, rank=rank),
+        parse_mode="Markdown")
+
+async def ping_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    t1 = time.time()
+    msg = await update.message.reply_text(TEXTS["pinging"])
+    ms = round((time.time() - t1) * 1000)
+    st = TEXTS["ping_fast"] if ms < 500 else (TEXTS["ping_ok"] if ms < 1000 else TEXTS["ping_slow"])
+    await msg.edit_text(
+        render("ping", ms=ms, status=st, time=time.strftime('%H:%M:%S UTC')),
+        parse_mode="Markdown")
+
+async def globalstats_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    st = analytics_snapshot()
+
+    def block(d):
+        return "\n".join(f"• {k}: {v}" for k, v in d.items()) or "• —"
+
+    top = "\n".join(f"{i}. {v['title'] or 'Untitled'} ({v['lookups']})"
+                    for i, v in enumerate(st["top_videos"][:5], 1)) or "—"
+    busiest = max(st["hours"].items(), key=lambda h: h[1], default=("—", 0))
+    await update.message.reply_text(render(
+        "globalstats", users=st["users"], users_today=st["users_today"],
+        busiest=busiest[0], busiest_count=busiest[1],
+        events=block(st["events"]), tiers=block(st["tiers"]), errors=block(st["errors"]),
+        rejections=block(st["rejections"]), top=top))
 
 # ==================== Message Handler ====================
 
 async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    # Past the drain deadline - don't start anything the shutdown would cut off
+    if abort_transfers.is_set():
+        await update.message.reply_text(TEXTS["restarting"], parse_mode="Markdown")
+        return
+
     url = update.message.text.strip()
 
     if not is_facebook_url(url):
-        await update.message.reply_text(
-            "🚫 **Invalid Link!**\n\n"
-            "Send a valid Facebook video/reel link.\n\n"
-            "💡 Example:\n`https://www.facebook.com/reel/569975832234512`",
-            parse_mode="Markdown")
+        track("lookup", uid, ok=0, r="invalid_link")
+        await update.message.reply_text(TEXTS["invalid_link"], parse_mode="Markdown")
         return
 
-    if "downloads" not in ctx.user_data:
-        ctx.user_data["downloads"] = 0
-        ctx.user_data["joined"] = time.strftime("%Y-%m-%d")
+    # Shed load before anything upstream is touched
+    if not is_exempt(uid):
+        wait = rate_limit_wait(uid)
+        if wait:
+            track("rejected", uid, r="rate_limit")
+            await update.message.reply_text(render("slow_down", wait=wait), parse_mode="Markdown")
+            return
+        if quota_left(uid) <= 0:
+            track("rejected", uid, r="quota")
+            await update.message.reply_text(TEXTS["quota"], parse_mode="Markdown")
+            return
 
-    msg = await update.message.reply_text(
-        "🔍 **Processing...**\n⏳ Fetching video details.", parse_mode="Markdown")
+    await lookup_link(update, ctx, url)
 
-    data = fetch_video_data(url)
+async def lookup_link(update: Update, ctx: ContextTypes.DEFAULT_TYPE, url):
+    """Fetches video info for a FB link and offers the quality buttons"""
+    uid = update.effective_user.id
+    ensure_user(ctx)
+
+    msg = await update.message.reply_text(TEXTS["processing"], parse_mode="Markdown")
+
+    data, fetched = cached_video_data(url)
 
     if not data or data.get("error", True):
-        await msg.edit_text(
-            "❌ **Video Not Found!**\n\n"
-            "┌ 🔒 Might be private\n├ 🗑️ Might be deleted\n└ 🔗 Invalid link\n\n"
-            "💡 Check and try again.", parse_mode="Markdown")
+        track("lookup", uid, url=url, ok=0, r="not_found" if data else "api_error")
+        await msg.edit_text(TEXTS["not_found"], parse_mode="Markdown")
         return
 
     title = data.get("title", "Untitled")
@@ -498,10 +1194,12 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     auds = [m for m in medias if m.get("type") == "audio"]
 
     if not vids and not auds:
-        await msg.edit_text("❌ No downloadable media found!", parse_mode="Markdown")
+        track("lookup", uid, url=url, ok=0, r="no_media")
+        await msg.edit_text(TEXTS["no_media"], parse_mode="Markdown")
         return
 
-    await msg.edit_text("📦 **Checking file sizes...**", parse_mode="Markdown")
+    track("lookup", uid, url=url, ok=1, ti=title[:60])
+    await msg.edit_text(TEXTS["checking_sizes"], parse_mode="Markdown")
 
     for m in vids + auds:
         s = get_size(m["url"])
@@ -509,11 +1207,13 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         m["size_label"] = fmt_size(s)
         # Mark if file is large
         m["is_large"] = s > MAX_DOWNLOAD_SIZE
+        m["expires"] = url_expiry(m["url"])
 
     ctx.user_data["video_data"] = {
         "title": title, "author": author,
         "videos": vids, "audios": auds,
         "thumbnail": thumb, "url": url,
+        "fetched": fetched,
     }
 
     kb = []
@@ -523,32 +1223,25 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         sl = v.get("size_label", "")
         large_tag = " 🔗" if v.get("is_large") else ""
         st = f" • {sl}{large_tag}" if sl != "Unknown" else large_tag
-        kb.append([InlineKeyboardButton(f"{q_icon(q)} {q} ({ext}{st})", callback_data=f"v_{i}")])
+        kb.append([InlineKeyboardButton(
+            render("btn_video", icon=q_icon(q), quality=q, ext=ext, size=st), callback_data=f"v_{i}")])
 
     for i, a in enumerate(auds):
         ext = a.get("extension", "mp3").upper()
         sl = a.get("size_label", "")
         large_tag = " 🔗" if a.get("is_large") else ""
         st = f" • {sl}{large_tag}" if sl != "Unknown" else large_tag
-        kb.append([InlineKeyboardButton(f"🎵 Audio ({ext}{st})", callback_data=f"a_{i}")])
+        kb.append([InlineKeyboardButton(render("btn_audio", ext=ext, size=st), callback_data=f"a_{i}")])
 
-    kb.append([InlineKeyboardButton("🔗 Open on Facebook", url=url)])
+    kb.append([InlineKeyboardButton(TEXTS["btn_open_fb"], url=url)])
 
     large_note = ""
     has_large = any(m.get("is_large") for m in vids + auds)
     if has_large:
-        large_note = "\n\n💡 🔗 = Large file, download link will be provided"
+        large_note = TEXTS["large_note"]
 
-    info = (
-        "✅ **Video Found!**\n\n"
-        "━━━━━━━━━━━━━━━━━━━━\n"
-        f"📌 **Title:** {title}\n"
-        f"👤 **Author:** {author}\n"
-        f"⏱️ **Duration:** {dur}\n"
-        f"📦 **Formats:** {len(vids)} video, {len(auds)} audio\n"
-        "━━━━━━━━━━━━━━━━━━━━\n\n"
-        f"👇 **Select quality:**{large_note}"
-    )
+    info = render("video_found", title=title, author=author, duration=dur,
+                  videos=len(vids), audios=len(auds), large_note=large_note)
 
     await msg.delete()
 
@@ -564,83 +1257,63 @@ async def handle_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 # ==================== Callback ====================
 
+def menu_page(key):
+    """Callback that shows a pre-rendered menu page with a back button"""
+    async def page(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.edit_message_text(
+            TEXTS[key], parse_mode="Markdown", reply_markup=BACK_KB)
+    return page
+
+async def cb_ping(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        render("cb_ping", time=time.strftime('%H:%M:%S UTC')),
+        parse_mode="Markdown", reply_markup=BACK_KB)
+
+async def cb_back(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(
+        render("cb_back", name=update.effective_user.first_name),
+        parse_mode="Markdown", reply_markup=HOME_KB)
+
+CALLBACKS = {
+    "cb_help": menu_page("cb_help"),
+    "cb_supported": menu_page("cb_supported"),
+    "cb_about": menu_page("cb_about"),
+    "cb_dev": menu_page("cb_dev"),
+    "cb_privacy": menu_page("cb_privacy"),
+    "cb_ping": cb_ping,
+    "cb_back": cb_back,
+}
+
 async def button_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
-    d = q.data
-
-    back_kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="cb_back")]])
-
-    if d == "cb_help":
-        await q.edit_message_text(
-            "📖 **How to Use**\n\n"
-            "1️⃣ Copy a Facebook video link\n"
-            "2️⃣ Paste it here\n3️⃣ Choose quality\n"
-            "4️⃣ Get your file! 🎉\n\n"
-            f"🤖 {BOT_USERNAME}", parse_mode="Markdown", reply_markup=back_kb)
-        return
-
-    if d == "cb_supported":
-        await q.edit_message_text(
-            "📋 **Supported**\n\n✅ facebook.com/watch\n✅ facebook.com/reel\n"
-            "✅ facebook.com/video\n✅ fb.watch\n✅ m.facebook.com\n\n"
-            f"❌ Private/Stories/Live\n\n🤖 {BOT_USERNAME}",
-            parse_mode="Markdown", reply_markup=back_kb)
-        return
-
-    if d == "cb_about":
-        await q.edit_message_text(
-            f"ℹ️ **About**\n\n🤖 {BOT_USERNAME}\n📌 v{BOT_VERSION}\n"
-            f"👨‍💻 {DEVELOPER}\n🆓 Free\n\nMade with ❤️",
-            parse_mode="Markdown", reply_markup=back_kb)
-        return
-
-    if d == "cb_ping":
-        await q.edit_message_text(
-            f"🏓 **Pong!**\n🟢 Online\n🕐 {time.strftime('%H:%M:%S UTC')} ✅",
-            parse_mode="Markdown", reply_markup=back_kb)
-        return
-
-    if d == "cb_dev":
-        await q.edit_message_text(
-            f"👨‍💻 **Developer**\n\n{DEVELOPER}\n🐍 Python • ☁️ Render",
-            parse_mode="Markdown", reply_markup=back_kb)
-        return
-
-    if d == "cb_privacy":
-        await q.edit_message_text(
-            "🔒 **Privacy**\n\n🚫 No data stored\n🗑️ Files deleted instantly\n🔐 HTTPS ✅",
-            parse_mode="Markdown", reply_markup=back_kb)
+    # Menu buttons by exact match, anything else is a quality button (v_N / a_N)
+    handler = CALLBACKS.get(q.data)
+    if not handler:
+        await download_callback(update, ctx)  # answers the query itself
         return
+    await q.answer()
+    await handler(update, ctx)
 
-    if d == "cb_back":
-        u = update.effective_user
-        kb = [
-            [InlineKeyboardButton("📖 How to Use", callback_data="cb_help"),
-             InlineKeyboardButton("📋 Supported", callback_data="cb_supported")],
-            [InlineKeyboardButton("ℹ️ About", callback_data="cb_about"),
-             InlineKeyboardButton("🏓 Ping", callback_data="cb_ping")],
-            [InlineKeyboardButton("👨‍💻 Developer", callback_data="cb_dev"),
-             InlineKeyboardButton("🔒 Privacy", callback_data="cb_privacy")],
-        ]
-        await q.edit_message_text(
-            f"Hey **{u.first_name}**! 👋\n\n🎬 **Facebook Video Downloader**\n\n"
-            f"Send any FB link!\n\n🤖 {BOT_USERNAME}",
-            parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(kb))
+async def download_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    d = q.data
+    uid = update.effective_user.id
+    if abort_transfers.is_set():
+        await q.answer(TEXTS["restarting_alert"], show_alert=True)
         return
 
-    # === Download ===
     vd = ctx.user_data.get("video_data")
     if not vd:
-        await q.answer("⚠️ Session expired! Send link again.", show_alert=True)
+        await q.answer(TEXTS["session_expired"], show_alert=True)
         return
 
-    dl_url = None; mtype = None; qual = None; ext = "mp4"; fsize = 0; is_large = False
+    dl_url = None; mtype = None; qual = None; ext = "mp4"; fsize = 0; is_large = False; media = None
 
     if d.startswith("v_"):
         i = int(d.split("_")[1])
         vs = vd.get("videos", [])
         if i < len(vs):
+            media = vs[i]
             dl_url = vs[i]["url"]; qual = vs[i].get("quality", "?")
             ext = vs[i].get("extension", "mp4"); mtype = "video"
             fsize = vs[i].get("size", 0); is_large = vs[i].get("is_large", False)
@@ -649,47 +1322,63 @@ async def button_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         i = int(d.split("_")[1])
         aus = vd.get("audios", [])
         if i < len(aus):
+            media = aus[i]
             dl_url = aus[i]["url"]; qual = "Audio"
             ext = aus[i].get("extension", "mp3"); mtype = "audio"
             fsize = aus[i].get("size", 0); is_large = aus[i].get("is_large", False)
 
     if not dl_url:
-        await q.answer("❌ Link not found!", show_alert=True)
+        await q.answer(TEXTS["link_not_found"], show_alert=True)
         return
 
+    # Large files only get a link - no server bandwidth, no quota needed.
+    # Unknown sizes (0) still need some quota left; the real bytes are charged after.
+    sends = not (is_large and fsize > 0)
+    if sends and not is_exempt(uid):
+        wait = rate_limit_wait(uid, "send")
+        if wait:
+            track("rejected", uid, r="rate_limit")
+            await q.answer(render("slow_down_alert", wait=wait), show_alert=True)
+            return
+        if quota_left(uid) < max(fsize, 1):
+            track("rejected", uid, r="quota")
+            await q.answer(TEXTS["quota_alert"], show_alert=True)
+            return
+    await q.answer()
+
+    def refresh():
+        """Fresh url for this media (runs in the download thread)"""
+        if not refresh_links(vd):
+            return None
+        track("refresh", uid)
+        return media["url"]
+
+    # Signed links that are (nearly) expired would fail every tier
+    if link_expiring(media, vd):
+        dl_url = await asyncio.to_thread(refresh) or dl_url
+
     icon = q_icon(qual) if mtype == "video" else "🎵"
     size_label = fmt_size(fsize)
 
     # If file is known to be large, skip server download and give link directly
     if is_large and fsize > 0:
         direct_kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"⬇️ Download {qual} ({size_label})", url=dl_url)],
-            [InlineKeyboardButton("🔗 Open Facebook", url=vd.get("url", ""))],
+            [InlineKeyboardButton(render("btn_download", quality=qual, size=size_label), url=dl_url)],
+            [InlineKeyboardButton(TEXTS["btn_open_fb_short"], url=vd.get("url", ""))],
         ])
 
         ctx.user_data["downloads"] = ctx.user_data.get("downloads", 0) + 1
+        track("delivery", uid, url=vd.get("url", ""), q=qual, m="link")
 
         try:
             await q.edit_message_caption(
-                caption=(
-                    f"📥 **Download Link Ready!**\n\n"
-                    f"━━━━━━━━━━━━━━━━━━━━\n"
-                    f"📌 {vd['title']}\n"
-                    f"{icon} Quality: **{qual}**\n"
-                    f"📦 Size: **{size_label}**\n"
-                    f"━━━━━━━━━━━━━━━━━━━━\n\n"
-                    f"👆 Tap the button above to download!\n\n"
-                    f"💡 The file is too large to send via\n"
-                    f"Telegram, but you can download it\n"
-                    f"directly to your device.\n\n"
-                    f"📥 Downloads: {ctx.user_data['downloads']}\n\n"
-                    f"🤖 {BOT_USERNAME}"
-                ),
+                caption=render("link_ready_large", title=vd["title"], icon=icon, quality=qual,
+                               size=size_label, downloads=ctx.user_data["downloads"]),
                 reply_markup=direct_kb, parse_mode="Markdown")
         except:
             await ctx.bot.send_message(
                 chat_id=q.message.chat_id,
-                text=f"📥 **Download {qual}** ({size_label}):",
+                text=render("link_ready_short", quality=qual, size=size_label),
                 reply_markup=direct_kb, parse_mode="Markdown")
         return
 
@@ -697,80 +1386,110 @@ async def button_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     async def status(txt):
         try:
             await q.edit_message_caption(
-                caption=f"{txt}\n\n━━━━━━━━━━━━━━━━━━━━\n"
-                f"{icon} **{qual}** • {size_label}\n"
-                f"📌 {vd['title']}\n━━━━━━━━━━━━━━━━━━━━",
+                caption=render("progress", status=txt, icon=icon, quality=qual,
+                               size=size_label, title=vd["title"]),
                 parse_mode="Markdown")
         except: pass
 
-    ok, method = await smart_send(ctx, q.message.chat_id, dl_url, mtype, qual, vd, ext, fsize, status)
+    ok, method, sent = await run_transfer(
+        smart_send(ctx, q.message.chat_id, dl_url, mtype, qual, vd, ext, fsize, status, refresh))
+    charge_quota(uid, sent)  # what actually went through our server, also on failure
+    dl_url = media["url"]  # may have been refreshed mid-download
 
     if ok:
         ctx.user_data["downloads"] = ctx.user_data.get("downloads", 0) + 1
-        labels = {"direct": "⚡ Direct", "upload": "📤 Upload", "document": "📄 Document"}
+        track("delivery", uid, url=vd.get("url", ""), q=qual, m=method)
         try:
             await q.edit_message_caption(
-                caption=(
-                    f"✅ **Sent Successfully!**\n\n"
-                    f"━━━━━━━━━━━━━━━━━━━━\n"
-                    f"📌 {vd['title']}\n"
-                    f"{icon} **{qual}** • {size_label}\n"
-                    f"📡 {labels.get(method, method)}\n"
-                    f"📥 Downloads: {ctx.user_data['downloads']}\n"
-                    f"━━━━━━━━━━━━━━━━━━━━\n\n"
-                    f"Send another link! 🔗"),
+                caption=render("sent", title=vd["title"], icon=icon, quality=qual, size=size_label,
+                               method=TEXTS.get(f"method_{method}", method),
+                               downloads=ctx.user_data["downloads"]),
                 parse_mode="Markdown")
         except: pass
     else:
         # Give download link as fallback
         ctx.user_data["downloads"] = ctx.user_data.get("downloads", 0) + 1
+        track("delivery", uid, url=vd.get("url", ""), q=qual, m="link", r=method)
         fb_kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(f"⬇️ Download {qual} ({size_label})", url=dl_url)],
-            [InlineKeyboardButton("🔗 Open Facebook", url=vd.get("url", ""))]])
+            [InlineKeyboardButton(render("btn_download", quality=qual, size=size_label), url=dl_url)],
+            [InlineKeyboardButton(TEXTS["btn_open_fb_short"], url=vd.get("url", ""))]])
         try:
             await q.edit_message_caption(
-                caption=(
-                    f"📥 **Download Link Ready!**\n\n"
-                    f"━━━━━━━━━━━━━━━━━━━━\n"
-                    f"📌 {vd['title']}\n"
-                    f"{icon} **{qual}** • {size_label}\n"
-                    f"━━━━━━━━━━━━━━━━━━━━\n\n"
-                    f"👆 Tap button to download!\n\n"
-                    f"📥 Downloads: {ctx.user_data['downloads']}\n\n"
-                    f"🤖 {BOT_USERNAME}"),
+                caption=render("link_ready", title=vd["title"], icon=icon, quality=qual,
+                               size=size_label, downloads=ctx.user_data["downloads"]),
                 reply_markup=fb_kb, parse_mode="Markdown")
         except:
             await ctx.bot.send_message(chat_id=q.message.chat_id,
-                text=f"📥 Download:", reply_markup=fb_kb)
+                text=TEXTS["link_fallback"], reply_markup=fb_kb)
 
 # ==================== Error ====================
 
+async def drop_banned(update, ctx):
+    """Runs before every other handler - banned users get no reply at all"""
+    if update.effective_user and update.effective_user.id in BANNED_IDS:
+        raise ApplicationHandlerStop
+
+async def first_update(update, ctx):
+    if "first_update" not in startup_phases:
+        mark_phase("first_update")
+        logger.info("⏱️ Startup: " + ", ".join(f"{k} {v}ms" for k, v in startup_phases.items()))
+
 async def error_handler(update, ctx):
     logger.error(f"Error: {ctx.error}")
+    track("error", update.effective_user.id if update and update.effective_user else 0,
+          r=type(ctx.error).__name__)
     if update and update.effective_message:
         try:
             await update.effective_message.reply_text(
-                f"⚠️ Something went wrong. Try again.\n🤖 {BOT_USERNAME}")
+                TEXTS["error"])
         except: pass
 
 # ==================== Main ====================
 
+_bg_tasks = set()
+
+def background(coro):
+    """Runs coro as a task we keep a reference to (asyncio only holds weak ones)"""
+    t = asyncio.ensure_future(coro)
+    _bg_tasks.add(t)
+    t.add_done_callback(_bg_tasks.discard)
+    return t
+
 async def post_init(app):
-    await set_cmds(app)
-    logger.info("Commands set!")
+    mark_phase("telegram_init")
+    # Not needed to answer the first user - keep it off the startup path
+    background(set_cmds(app))
+
+    # Own SIGTERM handling so in-flight transfers can drain first
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: background(graceful_shutdown(app)))
+
+async def post_shutdown(app):
+    # After Application.stop() - the tail of the update queue has been handled,
+    # so its events are in this last flush too
+    analytics_stop.set()
+    await asyncio.to_thread(flush_events, True)
 
 def main():
     if not TELEGRAM_BOT_TOKEN:
         logger.error("TOKEN not set!")
         return
 
+    # Health endpoint first, so Render sees the service as up while we connect
     Thread(target=run_flask, daemon=True).start()
     logger.info(f"Flask on :{PORT}")
+    Thread(target=sweep_temp_files, daemon=True).start()
+    if os.path.realpath(DATA_DIR).startswith(os.path.realpath(tempfile.gettempdir())):
+        logger.warning(f"DATA_DIR is {DATA_DIR} - analytics and caches reset on every deploy")
+    Thread(target=analytics_writer, daemon=True).start()
 
     app = (Application.builder().token(TELEGRAM_BOT_TOKEN)
         .read_timeout(300).write_timeout(300).connect_timeout(120)
-        .post_init(post_init).build())
+        .post_init(post_init).post_shutdown(post_shutdown).build())
 
+    app.add_handler(TypeHandler(Update, drop_banned), group=-2)
+    app.add_handler(TypeHandler(Update, first_update), group=-1)
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("about", about_command))
@@ -779,12 +1498,14 @@ def main():
     app.add_handler(CommandHandler("ping", ping_command))
     app.add_handler(CommandHandler("developer", developer_command))
     app.add_handler(CommandHandler("privacy", privacy_command))
+    app.add_handler(CommandHandler("globalstats", globalstats_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     app.add_handler(CallbackQueryHandler(button_callback))
     app.add_error_handler(error_handler)
 
     logger.info("🚀 Bot starting...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    # Keep updates that arrived while we were down (e.g. during a redeploy)
+    app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=False, stop_signals=None)
 
 if __name__ == "__main__":
     main()